@@ -43,3 +43,15 @@ def get_connection():
         return redis.Redis(**diffs_settings['redis'])
     else:
         return fakeredis.FakeRedis()
+
+
+def get_replica_connections():
+    """Helper method to get the redis connections of the read replicas configured by settings"""
+    import redis
+    from .settings import diffs_settings
+
+    if not diffs_settings['test_mode']:
+        return [redis.Redis(**replica) for replica in diffs_settings['replicas']]
+    else:
+        # reads go to the fake primary in test mode
+        return []
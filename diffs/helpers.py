@@ -1,9 +1,40 @@
+import json
 import time
 
 from django.utils import timezone
+import six
 
 
 def precise_timestamp(dt=None):
     """Returns a float representing a utc timestamp with milliseconds."""
     now = dt or timezone.now()
-    return time.mktime(now.utctimetuple()) * 1000 + now.microsecond / 1000
\ No newline at end of file
+    return time.mktime(now.utctimetuple()) * 1000 + now.microsecond / 1000
+
+
+def merge_diff_data(old, new):
+    """
+    Merges the data of two diffs for the same object.
+
+    Nested dicts are merged key by key and the values of ``new`` win. Lists of the same
+    length (like the output of ``django.core.serializers``) are merged item by item.
+    Anything else is replaced by ``new``.
+    """
+    if isinstance(old, six.string_types):
+        old = json.loads(old)
+    if isinstance(new, six.string_types):
+        new = json.loads(new)
+
+    return _merge(old, new)
+
+
+def _merge(old, new):
+    if isinstance(old, dict) and isinstance(new, dict):
+        merged = dict(old)
+        for key, value in new.items():
+            merged[key] = _merge(merged[key], value) if key in merged else value
+        return merged
+
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        return [_merge(o, n) for o, n in zip(old, new)]
+
+    return new
@@ -1,13 +1,38 @@
+from contextlib import contextmanager
+import itertools
 import json
+import logging
+import threading
+import time
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.utils.encoding import python_2_unicode_compatible
+from redis import exceptions
 import six
 
-from . import get_connection
-from .helpers import precise_timestamp
+from . import get_connection, get_replica_connections
+from .helpers import merge_diff_data, precise_timestamp
 from .settings import diffs_settings
 
+logger = logging.getLogger("diffs")
+
+_routing = threading.local()
+
+
+@contextmanager
+def read_from_primary():
+    """
+    Context manager that routes all diff reads in the block to the primary.
+
+    Use it to read your own writes right after a save.
+    """
+    depth = getattr(_routing, 'primary_reads', 0)
+    _routing.primary_reads = depth + 1
+    try:
+        yield
+    finally:
+        _routing.primary_reads = depth
+
 
 @python_2_unicode_compatible
 class Diff(object):
@@ -17,10 +42,11 @@ class Diff(object):
     def from_storage(cls, diff_str, timestamp=None):
         """Instantiates a diff object from a diff json str from redis"""
         diff = json.loads(diff_str.decode('utf-8'))
-        return cls(diff['data'], diff['created'], timestamp)
+        return cls(diff['data'], diff['created'], timestamp, diff.get('source'))
 
-    def __init__(self, data=None, created=None, timestamp=None):
+    def __init__(self, data=None, created=None, timestamp=None, source=None):
         self.created = created
+        self.source = source
 
         if isinstance(data, six.string_types):
             data = json.loads(data)
@@ -40,19 +66,61 @@ class Diff(object):
 
     def typecast_for_storage(self):
         """Returns a tuple of the (diff_str, score) for redis"""
-        return json.dumps({'data': self.data, 'created': self.created}, cls=DjangoJSONEncoder), self.timestamp
+        diff = {'data': self.data, 'created': self.created}
+        if self.source is not None:
+            diff['source'] = self.source
+        return json.dumps(diff, cls=DjangoJSONEncoder), self.timestamp
+
+
+class ReplicaRouter(object):
+    """
+    Wraps the redis read replicas and sends each command to the next replica in round-robin order.
+
+    Falls back to the other replicas and finally the primary when a replica can't be reached.
+    A replica that can't be reached is skipped for ``retry_interval`` seconds.
+    """
+
+    def __init__(self, primary, replicas, retry_interval=30):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.retry_interval = retry_interval
+        self._counter = itertools.count()
+        self._down_until = {}
+
+    def get_connections(self):
+        """Returns the connections to try in order for the next read."""
+        if getattr(_routing, 'primary_reads', 0) or not self.replicas:
+            return [self.primary]
+        start = next(self._counter) % len(self.replicas)
+        now = time.time()
+        replicas = [db for db in self.replicas[start:] + self.replicas[:start]
+                    if self._down_until.get(db, 0) <= now]
+        return replicas + [self.primary]
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            connections = self.get_connections()
+            for db in connections[:-1]:
+                try:
+                    return getattr(db, name)(*args, **kwargs)
+                except (exceptions.ConnectionError, exceptions.TimeoutError) as err:
+                    logger.warning("Read from replica failed: %s", err)
+                    self._down_until[db] = time.time() + self.retry_interval
+            return getattr(connections[-1], name)(*args, **kwargs)
+        return command
 
 
 class DiffSortedSet(object):
     """
     Simple class that represents a single SortedSet in redis.
 
-    By default it returns diff objects.
+    By default it returns diff objects. Reads go to ``read_db`` and writes to ``db``.
     """
 
-    def __init__(self, key, db):
+    def __init__(self, key, db, read_db=None):
         self.key = key
         self.db = db
+        self.read_db = read_db or db
 
     def __getitem__(self, index):
         if isinstance(index, slice):
@@ -84,7 +152,7 @@ class DiffSortedSet(object):
         Returns the minimum score in the SortedSet.
         """
         try:
-            return self.zscore(self.db.zrange(self.key, 0, 0)[0])
+            return self.read_db.zrange(self.key, 0, 0, withscores=True)[0][1]
         except IndexError:
             return None
 
@@ -94,7 +162,7 @@ class DiffSortedSet(object):
         Returns the maximum score in the SortedSet.
         """
         try:
-            return self.zscore(self.db.zrange(self.key, -1, -1)[0])
+            return self.read_db.zrange(self.key, -1, -1, withscores=True)[0][1]
         except IndexError:
             return None
 
@@ -109,19 +177,45 @@ class DiffSortedSet(object):
         return self.db.zadd(self.key, *_members)
 
     def zrange(self, start, stop, withscores=False):
-        return self._process_response(self.db.zrange(self.key, start, stop, withscores=withscores))
+        return self._process_response(self.read_db.zrange(self.key, start, stop, withscores=withscores))
 
     def zrangebyscore(self, min, max, **kwargs):
-        return self._process_response(self.db.zrangebyscore(self.key, min, max, **kwargs))
+        return self._process_response(self.read_db.zrangebyscore(self.key, min, max, **kwargs))
 
     def zrevrangebyscore(self, max, min, **kwargs):
-        return self._process_response(self.db.zrevrangebyscore(self.key, max, min, **kwargs))
+        return self._process_response(self.read_db.zrevrangebyscore(self.key, max, min, **kwargs))
 
     def zrevrange(self, start, stop, **kwargs):
-        return self._process_response(self.db.zrevrange(self.key, start, stop, **kwargs))
+        return self._process_response(self.read_db.zrevrange(self.key, start, stop, **kwargs))
 
     def zscore(self, elem):
-        return self.db.zscore(self.key, elem)
+        return self.read_db.zscore(self.key, elem)
+
+    def zrem(self, *members):
+        return self.db.zrem(self.key, *members)
+
+    def coalesce(self, diff, window, merge=merge_diff_data):
+        """
+        Adds the diff to the SortedSet, merging it into the latest diff when that one has the
+        same source and is at most ``window`` seconds older. The merged diff replaces the latest one.
+        """
+        def _coalesce(pipe):
+            result = diff
+            latest = pipe.zrevrange(self.key, 0, 0, withscores=True)
+            previous = Diff.from_storage(*latest[0]) if latest else None
+            if (previous and previous.source == diff.source and
+                    0 <= diff.timestamp - previous.timestamp <= window * 1000):
+                result = Diff(data=merge(previous.data, diff.data),
+                              created=previous.created or diff.created,
+                              timestamp=diff.timestamp,
+                              source=diff.source)
+            pipe.multi()
+            if result is not diff:
+                pipe.zrem(self.key, latest[0][0])
+            pipe.zadd(self.key, *result.typecast_for_storage())
+            return result
+
+        return self.db.transaction(_coalesce, self.key, value_from_callable=True)
 
 
 class DiffModelDescriptor(object):
@@ -149,22 +243,34 @@ class DiffModelManager(object):
     def __init__(self, model=None, prefix=diffs_settings['prefix']):
         self.model = model
         self.db = get_connection()
+        self.read_db = ReplicaRouter(self.db, get_replica_connections(),
+                                     retry_interval=diffs_settings['replica_retry_interval'])
         self.prefix = prefix
 
     def _generate_key(self, pk, model_cls=None):
         model = model_cls or self.model
         return '{}{}-{}'.format(self.prefix, model.__name__, str(pk))
 
-    def get_sortedset(self, pk, model_cls=None):
-        """Returns the SortedSet object"""
+    def get_sortedset(self, pk, model_cls=None, use_primary=False):
+        """Returns the SortedSet object. Reads go to the replicas unless use_primary is set."""
         key = self._generate_key(pk, model_cls=model_cls)
-        return DiffSortedSet(key, self.db)
+        return DiffSortedSet(key, self.db, self.db if use_primary else self.read_db)
 
-    def get_by_object_id(self, pk):
-        return list(self.get_sortedset(pk))
+    def get_by_object_id(self, pk, use_primary=False):
+        return list(self.get_sortedset(pk, use_primary=use_primary))
 
-    def create(self, data=None, created=None, pk=None, model_cls=None, timestamp=None):
-        """Create a new diff with the given params."""
-        diff = Diff(data=data, created=created, timestamp=timestamp)
-        self.get_sortedset(pk, model_cls=model_cls).zadd(*diff.typecast_for_storage())
+    def create(self, data=None, created=None, pk=None, model_cls=None, timestamp=None,
+               coalesce_window=None, merge=merge_diff_data, source=None):
+        """
+        Create a new diff with the given params.
+
+        ``source`` identifies the saved object when the diff is stored under a parent. When
+        ``coalesce_window`` is set the diff is merged into the latest diff of the object if that one
+        has the same source and is at most ``coalesce_window`` seconds older.
+        """
+        diff = Diff(data=data, created=created, timestamp=timestamp, source=source)
+        sortedset = self.get_sortedset(pk, model_cls=model_cls)
+        if coalesce_window:
+            return sortedset.coalesce(diff, coalesce_window, merge=merge)
+        sortedset.zadd(*diff.typecast_for_storage())
         return diff
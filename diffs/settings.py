@@ -7,9 +7,13 @@ DEFAULTS = {
         'port': 6379,
         'db': 0,
     },
+    'replicas': [],
+    'replica_retry_interval': 30,
     'max_element_age': 60*60,
     'use_transactions': True,
     'test_mode': False,
+    'coalesce_diffs': False,
+    'coalesce_window': 0,
     'prefix': 'diffs:'
 }
 
@@ -24,13 +28,17 @@ def merge_settings(defaults, user_settings):
     if not user_settings:
         return merged
 
-    for setting in ('max_element_age', 'use_transactions', 'test_mode'):
+    for setting in ('max_element_age', 'use_transactions', 'test_mode', 'coalesce_diffs', 'coalesce_window',
+                    'replica_retry_interval'):
         if setting in user_settings:
             merged[setting] = user_settings[setting]
 
     if 'redis' in user_settings:
         merged['redis'].update(user_settings['redis'])
 
+    if 'replicas' in user_settings:
+        merged['replicas'] = [dict(merged['redis'], **replica) for replica in user_settings['replicas']]
+
     return merged
 
 diffs_settings = merge_settings(DEFAULTS, USER_SETTINGS)
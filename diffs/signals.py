@@ -1,16 +1,20 @@
 from __future__ import absolute_import, unicode_literals
 import logging
+import threading
+import weakref
 
 from django.core import serializers
 from django.db import connection
 from django.db.models.signals import pre_save, post_save
 
-from .helpers import precise_timestamp
+from .helpers import merge_diff_data, precise_timestamp
 
 from .settings import diffs_settings
 
 logger = logging.getLogger("diffs")
 
+_pending = threading.local()
+
 
 def on_pre_save(sender, instance, **kwargs):
     instance.__dirty_fields = instance.get_dirty_fields()
@@ -43,9 +47,18 @@ def on_post_save(sender, instance, created, **kwargs):
                 'model_cls': model.__class__,
                 'timestamp': getattr(instance, '_last_save_at', precise_timestamp())
             }
+            if diffs_settings['coalesce_diffs']:
+                create_kwargs['coalesce_window'] = diffs_settings['coalesce_window']
+                # only diffs of the same saved object are merged, even when stored under a parent
+                create_kwargs['source'] = '{}-{}'.format(instance.__class__.__name__, instance.pk)
+                if hasattr(instance, 'merge_diff'):
+                    create_kwargs['merge'] = instance.merge_diff
             # Respect the transaction if we can and should.
             if hasattr(connection, 'on_commit') and diffs_settings['use_transactions']:
-                connection.on_commit(lambda: sender.diffs.create(**create_kwargs))
+                if diffs_settings['coalesce_diffs']:
+                    add_pending_diff(sender, create_kwargs)
+                else:
+                    connection.on_commit(lambda: sender.diffs.create(**create_kwargs))
             else:
                 sender.diffs.create(**create_kwargs)
         else:
@@ -56,6 +69,88 @@ def on_post_save(sender, instance, created, **kwargs):
         logger.debug("Skipped diff because no fields had changed.")
 
 
+class PendingDiff(object):
+    """
+    Saves of a single object in a transaction that are merged into one diff on commit.
+
+    Every save registers its own ``on_commit`` callback. Django drops the callbacks of saves
+    in rolled back savepoints, so a save only counts once its callback ran.
+    """
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.saves = []
+        self.committing = False
+        self.stored = None
+
+    def add(self, create_kwargs):
+        """Adds the create kwargs of a save of the object."""
+        index = len(self.saves)
+        self.saves.append({
+            'kwargs': create_kwargs,
+            'savepoint_ids': set(connection.savepoint_ids),
+            'committed': False,
+        })
+        connection.on_commit(lambda: self.commit(index))
+
+    def commit(self, index):
+        """Marks the save as committed and creates the diff unless a later save will."""
+        self.committing = True
+        save = self.saves[index]
+        save['committed'] = True
+
+        # A later save in the same or an enclosing savepoint is only rolled back together with
+        # this one, so its callback will run and create the diff.
+        if any(later['savepoint_ids'] <= save['savepoint_ids'] for later in self.saves[index + 1:]):
+            return
+
+        kwargs = None
+        if self.stored is not None:
+            kwargs = {'data': self.stored.data, 'created': self.stored.created}
+        for save in self.saves[:index + 1]:
+            if save['committed']:
+                kwargs = merge_create_kwargs(kwargs, save['kwargs'])
+
+        # A save in a nested savepoint was committed after the diff was stored, replace it.
+        if self.stored is not None:
+            sortedset = self.sender.diffs.get_sortedset(kwargs['pk'], model_cls=kwargs['model_cls'])
+            sortedset.zrem(self.stored.typecast_for_storage()[0])
+
+        self.stored = self.sender.diffs.create(**kwargs)
+
+
+def merge_create_kwargs(kwargs, create_kwargs):
+    """Merges the create kwargs of a later save into the kwargs of the earlier saves."""
+    if kwargs is None:
+        return dict(create_kwargs)
+    merge = create_kwargs.get('merge', merge_diff_data)
+    return dict(create_kwargs,
+                data=merge(kwargs['data'], create_kwargs['data']),
+                created=kwargs['created'] or create_kwargs['created'])
+
+
+def add_pending_diff(sender, create_kwargs):
+    """
+    Defers the creation of a diff to ``on_commit``. When a diff for the same object is already
+    pending in the current transaction the new diff is merged into it instead.
+    """
+    # Pending diffs are weakly referenced so they are removed once Django releases their
+    # on_commit callbacks. Saves of a dropped diff that is still referenced never count.
+    if not hasattr(_pending, 'diffs'):
+        _pending.diffs = weakref.WeakValueDictionary()
+
+    key = (connection.alias, create_kwargs['model_cls'], create_kwargs['pk'], create_kwargs['source'])
+    pending = _pending.diffs.get(key)
+
+    if pending is None or pending.committing:
+        pending = PendingDiff(sender)
+        _pending.diffs[key] = pending
+    else:
+        logger.debug("Merged diff into pending diff.")
+
+    pending.add(create_kwargs)
+
+
 def serialize_object(instance, dirty_fields):
     """Serializes a django model using the default serialization."""
     return serializers.serialize('json', [instance], fields=list(dirty_fields.keys()))
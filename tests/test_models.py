@@ -1,15 +1,24 @@
 from datetime import timedelta, datetime
 import json
+import time
 import types
 
 import diffs
-from diffs.helpers import precise_timestamp
-from diffs.models import Diff
-from diffs.settings import diffs_settings
+from diffs import signals
+from diffs.helpers import merge_diff_data, precise_timestamp
+from diffs.models import Diff, DiffModelManager, ReplicaRouter, read_from_primary
+from diffs.settings import DEFAULTS, diffs_settings, merge_settings
 
 from django.core.management import call_command
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
 from django.utils import timezone
+from redis.exceptions import ConnectionError
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
 
 from .mixins import TestModeMixin
 from .models import TestModel
@@ -36,6 +45,17 @@ class DiffModelTestCase(TestCase):
         result = diff.typecast_for_storage()
         self.assertIsNotNone(result)
 
+    def test_merge_diff_data(self):
+        """Asserts that diff data is merged with the later values winning"""
+        old = json.dumps([{'model': 'tests.testmodel', 'pk': 1, 'fields': {'name': 'one', 'other': 1}}])
+        new = [{'model': 'tests.testmodel', 'pk': 1, 'fields': {'name': 'two'}}]
+
+        expected = [{'model': 'tests.testmodel', 'pk': 1, 'fields': {'name': 'two', 'other': 1}}]
+
+        self.assertEqual(merge_diff_data(old, new), expected)
+        # It should replace values it can't merge
+        self.assertEqual(merge_diff_data({'test': [1, 2]}, {'test': [3]}), {'test': [3]})
+
 
 class DiffModelManagerTestCase(TestCase):
 
@@ -138,6 +158,317 @@ class DiffModelManagerTestCase(TestCase):
         self.assertEqual(len(parent_diffs), 2)
 
 
+class CoalesceDiffTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.connection = diffs.get_connection()
+        self.p = patch.dict(diffs_settings, coalesce_diffs=True, use_transactions=True)
+        self.p.start()
+
+    def tearDown(self):
+        self.p.stop()
+        self.connection.flushdb()
+
+    @classmethod
+    def setUpClass(cls):
+        # Register the class with diffs
+        diffs.register(TestModel)
+        super(CoalesceDiffTestCase, cls).setUpClass()
+
+    def test_transaction(self):
+        """Asserts that saves of the same object in a transaction create a single diff."""
+
+        with transaction.atomic():
+            tm = TestModel.objects.create(name='Example')
+            tm.name = 'example'
+            tm.save()
+            tm.name = 'final'
+            tm.save()
+
+        diffs = TestModel.diffs.get_by_object_id(tm.id)
+
+        # It should create one diff
+        self.assertEqual(len(diffs), 1)
+        # It should keep created and the last value
+        self.assertTrue(diffs[0].created)
+        self.assertEqual(diffs[0].data[0]['fields']['name'], 'final')
+
+    def test_rollback(self):
+        """Asserts that saves in a rolled back savepoint are not merged into the diff."""
+
+        with transaction.atomic():
+            tm = TestModel.objects.create(name='Example')
+            try:
+                with transaction.atomic():
+                    tm.name = 'example'
+                    tm.save()
+                    raise ValueError
+            except ValueError:
+                pass
+
+        diffs = TestModel.diffs.get_by_object_id(tm.id)
+
+        self.assertEqual(len(diffs), 1)
+        self.assertEqual(diffs[0].data[0]['fields']['name'], 'Example')
+
+    def test_nested_savepoint(self):
+        """Asserts that saves in a released savepoint are merged into the diff."""
+
+        with transaction.atomic():
+            tm = TestModel.objects.create(name='Example')
+            with transaction.atomic():
+                tm.name = 'example'
+                tm.save()
+            tm.name = 'final'
+            tm.save()
+
+        diffs = TestModel.diffs.get_by_object_id(tm.id)
+
+        # It should create one diff
+        self.assertEqual(len(diffs), 1)
+        self.assertTrue(diffs[0].created)
+        self.assertEqual(diffs[0].data[0]['fields']['name'], 'final')
+
+    def test_nested_savepoint_last(self):
+        """Asserts that a save in a released savepoint after the outer saves is merged into the diff."""
+
+        with transaction.atomic():
+            tm = TestModel.objects.create(name='Example')
+            with transaction.atomic():
+                tm.name = 'final'
+                tm.save()
+
+        diffs = TestModel.diffs.get_by_object_id(tm.id)
+
+        self.assertEqual(len(diffs), 1)
+        self.assertTrue(diffs[0].created)
+        self.assertEqual(diffs[0].data[0]['fields']['name'], 'final')
+
+    def test_rollback_merge(self):
+        """Asserts that saves in a rolled back savepoint are left out of the merged diff."""
+
+        def serialize_diff(self, dirty_fields, created=False):
+            return {self.name: True}
+
+        with transaction.atomic():
+            tm = TestModel(name='Example')
+            tm.serialize_diff = types.MethodType(serialize_diff, tm)
+            tm.save()
+            try:
+                with transaction.atomic():
+                    tm.name = 'example'
+                    tm.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            tm.name = 'final'
+            tm.save()
+
+        diffs = TestModel.diffs.get_by_object_id(tm.id)
+
+        self.assertEqual(len(diffs), 1)
+        self.assertEqual(diffs[0].data, {'Example': True, 'final': True})
+
+    def test_rollback_cleanup(self):
+        """Asserts that pending diffs are removed when the transaction rolls back."""
+
+        try:
+            with transaction.atomic():
+                tm = TestModel.objects.create(name='Example')
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.assertNotIn(('default', TestModel, tm.id), signals._pending.diffs)
+
+    def test_merge_diff(self):
+        """Asserts the merge_diff method is called when available."""
+
+        def merge_diff(self, old, new):
+            return {'merged': True}
+
+        with transaction.atomic():
+            tm = TestModel.objects.create(name='Example')
+            tm.merge_diff = types.MethodType(merge_diff, tm)
+            tm.name = 'example'
+            tm.save()
+
+        self.assertEqual(TestModel.diffs.get_by_object_id(tm.id)[0].data, {'merged': True})
+
+    def test_window(self):
+        """Asserts that diffs within the coalesce_window are merged into the latest diff."""
+
+        with patch.dict(diffs_settings, use_transactions=False, coalesce_window=60):
+            tm = TestModel.objects.create(name='Example')
+            tm.name = 'example'
+            tm.save()
+
+            diffs = TestModel.diffs.get_by_object_id(tm.id)
+
+            # It should replace the first diff
+            self.assertEqual(len(diffs), 1)
+            self.assertTrue(diffs[0].created)
+            self.assertEqual(diffs[0].data[0]['fields']['name'], 'example')
+
+            tm._last_save_at = diffs[0].timestamp + 61 * 1000
+            tm.name = 'Example'
+            tm.save()
+
+            # It should create a new diff after the window
+            self.assertEqual(len(TestModel.diffs.get_by_object_id(tm.id)), 2)
+
+    def test_get_diff_parent(self):
+        """Asserts that saves of different children of a parent are not merged."""
+
+        parent = TestModel.objects.create(name='parent')
+        children = [TestModel.objects.create(name='a'), TestModel.objects.create(name='b')]
+
+        def get_diff_parent(self):
+            return parent
+
+        for child in children:
+            child.get_diff_parent = types.MethodType(get_diff_parent, child)
+
+        with transaction.atomic():
+            for child in children:
+                child.name = child.name.upper()
+                child.save()
+
+        names = [diff.data[0]['fields']['name'] for diff in TestModel.diffs.get_by_object_id(parent.id)]
+
+        # It should keep the changes of both children
+        self.assertEqual(names, ['parent', 'A', 'B'])
+
+        with patch.dict(diffs_settings, coalesce_window=60):
+            children[0].name = 'a'
+            children[0].save()
+
+        names = [diff.data[0]['fields']['name'] for diff in TestModel.diffs.get_by_object_id(parent.id)]
+
+        # It should not merge into the latest diff of the other child
+        self.assertEqual(names, ['parent', 'A', 'B', 'a'])
+
+
+class ReplicaRouterTestCase(TestCase):
+
+    def setUp(self):
+        self.primary = Mock()
+        self.replicas = [Mock(), Mock()]
+        self.router = ReplicaRouter(self.primary, self.replicas)
+
+        with patch.dict(diffs_settings, test_mode=True):
+            self.manager = DiffModelManager(TestModel)
+
+    def tearDown(self):
+        self.manager.db.flushdb()
+
+    def test_round_robin(self):
+        """Asserts that reads are spread over the replicas."""
+        self.router.zrange('key', 0, -1)
+        self.router.zrange('key', 0, -1)
+
+        for replica in self.replicas:
+            replica.zrange.assert_called_once_with('key', 0, -1)
+        self.assertFalse(self.primary.zrange.called)
+
+    def test_fallback(self):
+        """Asserts that reads fall back to the primary when the replicas fail."""
+        for replica in self.replicas:
+            replica.zrange.side_effect = ConnectionError
+
+        self.router.zrange('key', 0, -1)
+
+        self.primary.zrange.assert_called_once_with('key', 0, -1)
+
+    def test_mark_down(self):
+        """Asserts that a replica that can't be reached is skipped until the retry interval passed."""
+        self.replicas[0].zrange.side_effect = ConnectionError
+
+        for i in range(3):
+            self.router.zrange('key', 0, -1)
+
+        self.assertEqual(self.replicas[0].zrange.call_count, 1)
+        self.assertEqual(self.replicas[1].zrange.call_count, 3)
+
+        with patch('diffs.models.time.time', return_value=time.time() + 31):
+            self.router.zrange('key', 0, -1)
+            self.router.zrange('key', 0, -1)
+
+        # It should try the replica again
+        self.assertEqual(self.replicas[0].zrange.call_count, 2)
+
+    def test_read_from_primary(self):
+        """Asserts that reads go to the primary inside read_from_primary."""
+        with read_from_primary():
+            self.router.zrange('key', 0, -1)
+
+        self.primary.zrange.assert_called_once_with('key', 0, -1)
+        for replica in self.replicas:
+            self.assertFalse(replica.zrange.called)
+
+    def test_manager(self):
+        """Asserts the manager reads from the replicas and writes to the primary."""
+        self.manager.read_db = self.router
+        self.manager.create(data={'test': 'data'}, pk=1)
+        self.replicas[0].zrange.return_value = []
+
+        self.assertEqual(self.manager.get_by_object_id(1), [])
+        self.assertEqual(len(self.manager.get_by_object_id(1, use_primary=True)), 1)
+
+    def test_scores(self):
+        """Asserts that min_score and max_score read from a single replica."""
+        for replica in self.replicas:
+            replica.zrange.return_value = [(b'diff', 5.0)]
+            replica.zscore.return_value = None
+
+        sortedset = self.manager.get_sortedset(1)
+        sortedset.read_db = self.router
+
+        self.assertEqual(sortedset.min_score, 5.0)
+        self.assertEqual(sortedset.max_score, 5.0)
+
+    def test_settings(self):
+        """Asserts that replicas inherit missing keys from the redis settings."""
+        defaults = dict(DEFAULTS, redis=dict(DEFAULTS['redis']))
+
+        merged = merge_settings(defaults, {'redis': {'host': 'primary', 'db': 1},
+                                           'replicas': [{'host': 'replica'}, {'port': 6380}]})
+
+        self.assertEqual(merged['replicas'], [
+            {'host': 'replica', 'port': 6379, 'db': 1},
+            {'host': 'primary', 'port': 6380, 'db': 1},
+        ])
+
+
+class ReplicaTestCase(TestCase):
+    """Needs a redis replica of the test server listening on port 6380."""
+
+    def setUp(self):
+        defaults = dict(DEFAULTS, redis=dict(DEFAULTS['redis']))
+        replicas = merge_settings(defaults, {'replicas': [{'port': 6380}]})['replicas']
+
+        with patch.dict(diffs_settings, replicas=replicas):
+            self.manager = DiffModelManager(TestModel)
+
+    def tearDown(self):
+        self.manager.db.flushdb()
+
+    def test_replica_reads(self):
+        """Asserts that diffs written to the primary are read from the replica."""
+        replica = self.manager.read_db.replicas[0]
+
+        self.manager.create(data={'test': 'data'}, pk=1)
+
+        self.assertEqual(len(self.manager.get_by_object_id(1, use_primary=True)), 1)
+
+        # wait for the replica to receive the write
+        self.manager.db.execute_command('WAIT', 1, 1000)
+
+        self.assertEqual(replica.connection_pool.connection_kwargs['port'], 6380)
+        self.assertIs(self.manager.read_db.get_connections()[0], replica)
+        self.assertEqual(len(self.manager.get_by_object_id(1)), 1)
+
+
 class PruneDiffTestCase(TestCase):
 
     def setUp(self):
@@ -178,3 +509,7 @@ class PruneDiffTestCase(TestCase):
 
 class FakeDiffModelManagerTestCase(TestModeMixin, DiffModelManagerTestCase):
     pass
+
+
+class FakeCoalesceDiffTestCase(TestModeMixin, CoalesceDiffTestCase):
+    pass